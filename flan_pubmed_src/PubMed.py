@@ -41,6 +41,21 @@ def parse(path):
     for l in g:
         yield eval(l)
 
+def first_fit_decreasing(lengths, capacity):
+    # Bin-pack sequence lengths into rows of at most `capacity` tokens, returns the sample indices of each row
+    bins = []
+    free = []
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        for b in range(len(bins)):
+            if free[b] >= lengths[idx]:
+                bins[b].append(idx)
+                free[b] -= lengths[idx]
+                break
+        else:
+            bins.append([idx])
+            free.append(capacity - lengths[idx])
+    return bins
+
     
 
 class PubMed_Dataset(Dataset):
@@ -63,6 +78,7 @@ class PubMed_Dataset(Dataset):
         self.label_map=load_pickle(os.path.join('PubMed','final_pub_label_map.pkl'))  #1
         self.re_id=load_pickle(os.path.join('PubMed','final_pub_re_id.pkl'))  #2
         self.l_max=self.args.max_text_length
+        self.task2id={task: i for i, task in enumerate(self.args.losses.split(','))}  # same order as InstructGLM.losses
         self.real_feature=load_pickle(os.path.join('PubMed','final_norm_pub_real_feature.pkl')) #3
         self.train_L1=load_pickle(os.path.join('PubMed','final_pub_L1.pkl'))  #4
 
@@ -3144,7 +3160,9 @@ class PubMed_Dataset(Dataset):
 
         word_mask = target_ids != self.tokenizer.pad_token_id
         target_ids[~word_mask] = -100
+        valid_lens = word_mask.sum(dim=1).clamp(min=1).float()   # per-sample loss denominators
         batch_entry['task'] = tasks
+        batch_entry['task_ids'] = torch.LongTensor([self.task2id[task] for task in tasks])
 
         batch_entry['source_text'] = source_text
         batch_entry['target_text'] = target_text
@@ -3154,6 +3172,31 @@ class PubMed_Dataset(Dataset):
         batch_entry['target_ids'] = target_ids
 
         batch_entry['loss_weights'] = loss_weights
+        batch_entry['valid_lens'] = valid_lens
+
+        if self.mode=='train' and args.pack_inputs:
+            # Prepacking: several prompts share one encoder row, attention is block-diagonal per prompt.
+            # T5 only uses relative positions, so each prompt sees the same position biases as unpacked.
+            # unpack_index maps every (sample, position) back to its slot in the flattened packed rows.
+            bins = first_fit_decreasing([entry['input_length'] for entry in batch], S_W_L)
+            packed_input_ids = torch.ones(len(bins), S_W_L, dtype=torch.long) * self.tokenizer.pad_token_id
+            packed_attention_mask = torch.zeros(len(bins), S_W_L, S_W_L, dtype=torch.bool)
+            unpack_index = torch.zeros(B, S_W_L, dtype=torch.long)
+            for r, members in enumerate(bins):
+                offset = 0
+                for i in members:
+                    length = batch[i]['input_length']
+                    packed_input_ids[r, offset:offset+length] = batch[i]['input_ids']
+                    packed_attention_mask[r, offset:offset+length, offset:offset+length] = True
+                    unpack_index[i, :length] = torch.arange(r*S_W_L+offset, r*S_W_L+offset+length)
+                    offset += length
+                # Let the trailing pad block attend to itself, an all-masked query row gives NaN under fp16
+                packed_attention_mask[r, offset:, offset:] = True
+
+            batch_entry['packed_input_ids'] = packed_input_ids
+            batch_entry['packed_attention_mask'] = packed_attention_mask
+            batch_entry['unpack_index'] = unpack_index
+
         batch_entry['temp_ids'] = temp_ids   
         if len(cate)!=0:
             batch_entry['cate'] = cate
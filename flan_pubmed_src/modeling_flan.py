@@ -28,6 +28,33 @@ num_heads)`.
 
 logger = logging.get_logger(__name__)
 
+# Token embedding shared by encoder and decoder: trainable text rows followed by graph-node rows
+class NodeEmbedding(nn.Module):
+    def __init__(self, text_embedding, num_nodes):
+        super().__init__()
+        self.text = text_embedding
+        self.num_text_tokens = text_embedding.num_embeddings
+        self.num_nodes = num_nodes
+        self.embedding_dim = text_embedding.embedding_dim
+
+        # Node rows are rewritten from the projected node features on every encoder pass, so they are
+        # a plain (detached) tensor rather than a parameter: no gradient, all-reduce or optimizer state
+        self.node_weight = None
+
+    def forward(self, input_ids, include_nodes=True):
+        is_node = input_ids >= self.num_text_tokens
+        embeds = self.text(input_ids.masked_fill(is_node, 0))
+        if include_nodes:
+            node_embeds = self.node_weight[(input_ids - self.num_text_tokens).clamp(min=0)]
+            return torch.where(is_node.unsqueeze(-1), node_embeds.to(embeds.dtype), embeds)
+        return embeds.masked_fill(is_node.unsqueeze(-1), 0.)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the split hold a single (text + node) 'weight' table
+        if prefix + 'weight' in state_dict:
+            state_dict[prefix + 'text.weight'] = state_dict.pop(prefix + 'weight')[:self.num_text_tokens]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 # The encoder for input token sequence
 class JointEncoder(T5Stack):  # not single block, but the entire Encoder
     def __init__(self, config, embed_tokens=None):
@@ -113,10 +140,8 @@ class JointEncoder(T5Stack):  # not single block, but the entire Encoder
             transfered=self.trans_2(self.rac(self.sln(self.trans_1(real_feature)))) + self.trans(real_feature)  
             inputs_embeds=transfered[input_ids]
 
-            #self.embed_tokens.weight.data[-169343:]=torch.zeros(19717,768).to(input_ids.device)
-            self.embed_tokens.weight.data[-19717:]=torch.zeros(19717,1024).to(input_ids.device)
-            inputs_embeds = inputs_embeds + self.embed_tokens(input_ids) ### embedding step - add HERE ###
-            self.embed_tokens.weight.data[-19717:]=transfered[-19717:]
+            inputs_embeds = inputs_embeds + self.embed_tokens(input_ids, include_nodes=False) ### embedding step - add HERE ###
+            self.embed_tokens.node_weight = transfered[-self.embed_tokens.num_nodes:].detach()   # node rows seen by the decoder
 
         batch_size, seq_length = input_shape
 
@@ -330,6 +355,18 @@ class GLM(T5ForConditionalGeneration):
         self.model_parallel = False
         self.device_map = None
 
+    def add_node_embeddings(self, num_text_tokens, num_nodes):
+        # Text rows keep the pretrained vectors; node rows are produced by the encoder from real_feature
+        text = nn.Embedding(num_text_tokens, self.model_dim).to(self.shared.weight.device)
+        text.weight.data.copy_(self.shared.weight.data[:num_text_tokens])
+        self.shared = NodeEmbedding(text, num_nodes)
+        self.encoder.set_input_embeddings(self.shared)
+        self.decoder.set_input_embeddings(self.shared)
+
+        # The LM head still scores every node token
+        self.lm_head = self._get_resized_lm_head(self.lm_head, num_text_tokens + num_nodes)
+        self.config.vocab_size = num_text_tokens + num_nodes
+
     
     def forward(
         self,
@@ -351,6 +388,9 @@ class GLM(T5ForConditionalGeneration):
         reduce_loss=False,
         decoder_head_mask = None,
         cross_attn_head_mask = None,
+        packed_input_ids=None,
+        packed_attention_mask=None,
+        unpack_index=None,
         **kwargs,
     ):
 
@@ -365,6 +405,20 @@ class GLM(T5ForConditionalGeneration):
                 warnings.warn(__HEAD_MASK_WARNING_MSG, FutureWarning)
                 decoder_head_mask = head_mask
 
+        # Packed prompts: encode the shared rows, then gather the states back to one row per sample
+        if encoder_outputs is None and packed_input_ids is not None:
+            packed_outputs = self.encoder(
+                input_ids=packed_input_ids,
+                real_feature=real_feature,
+                attention_mask=packed_attention_mask,
+                head_mask=head_mask,
+                return_dict=True,
+            )
+            packed_states = packed_outputs.last_hidden_state
+            encoder_outputs = BaseModelOutput(
+                last_hidden_state=packed_states.reshape(-1, packed_states.size(-1))[unpack_index],
+            )
+
         # Encode if needed (training, first prediction pass)
         if encoder_outputs is None:
             # Convert encoder inputs in embeddings if needed
@@ -17,6 +17,13 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def epoch_fraction(v):
+    v = float(v)
+    if not 0 < v <= 1:
+        raise argparse.ArgumentTypeError('Fraction of an epoch in (0, 1] expected.')
+    return v
+
+
 def is_interactive():
     import __main__ as main
     return not hasattr(main, '__file__')
@@ -65,6 +72,7 @@ def parse_args(parse=True, **optional_kwargs):
 
     # Checkpoint
     parser.add_argument('--output', type=str, default='snap/pretrain')
+    parser.add_argument('--save_every_frac', type=epoch_fraction, default=0.25, help='fraction of an epoch between intermediate checkpoints')
     #parser.add_argument('--load', type=str, default=None, help='Abandoned')
     parser.add_argument('--from_scratch', action='store_true')
     parser.add_argument('--inference', action='store_true')
@@ -72,7 +80,13 @@ def parse_args(parse=True, **optional_kwargs):
     # CPU/GPU
     parser.add_argument("--multiGPU", action='store_const', default=False, const=True)
     parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--bf16', action='store_true', help='bf16 autocast without loss scaling, overrides --fp16')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the training forward (PyTorch >= 2.0)')
     parser.add_argument("--distributed", action='store_true')
+    parser.add_argument('--comm_hook', type=str, default='none', choices=['none', 'fp16', 'bf16'], help='DDP gradient compression hook')
+    parser.add_argument('--bucket_cap_mb', type=int, default=50, help='DDP gradient bucket size')
+    parser.add_argument('--sparse_embedding_grad', action='store_true', help='all-reduce only the touched rows of the token embedding gradient')
+    parser.add_argument('--quantize_lm_head_grad', action='store_true', help='communicate the LM head gradient as block-wise int8 (NCCL backend)')
     parser.add_argument("--num_workers", default=0, type=int)
     parser.add_argument('--local_rank', type=int, default=-1)
 
@@ -82,6 +96,7 @@ def parse_args(parse=True, **optional_kwargs):
     parser.add_argument('--whole_word_embed', action='store_true')
 
     parser.add_argument('--max_text_length', type=int, default=512)
+    parser.add_argument('--pack_inputs', action='store_true', help='pack several training prompts into each encoder row')
 
     # Training
     parser.add_argument('--batch_size', type=int, default=256)
@@ -91,6 +106,7 @@ def parse_args(parse=True, **optional_kwargs):
     parser.add_argument('--weight_decay', type=float, default=0.0)    
     parser.add_argument('--clip_grad_norm', type=float, default=-1.0)
     parser.add_argument('--gradient_accumulation_steps', type=int, default=1)
+    parser.add_argument('--gradient_checkpointing', action='store_true', help='trade recomputation for activation memory')
     parser.add_argument('--lr', type=float, default=8e-5)
     parser.add_argument('--adam_eps', type=float, default=1e-8)
     parser.add_argument('--adam_beta1', type=float, default=0.9)
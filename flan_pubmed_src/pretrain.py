@@ -1,4 +1,5 @@
 import collections
+import contextlib
 from dis import dis
 import os
 import random
@@ -13,12 +14,13 @@ import torch
 import torch.nn as nn
 from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 import torch.backends.cudnn as cudnn
 
 from param import parse_args
 from pretrain_data import get_loader
 from utils import LossMeter
-from dist_utils import reduce_dict, new_reduce_dict
+from dist_utils import reduce_dict, new_reduce_dict, SparseRowsHookState, sparse_rows_hook, BlockQuantizedHookState, block_quantized_hook
 
 _use_native_amp = False
 _use_apex = False
@@ -51,10 +53,15 @@ class Trainer(TrainerBase):
 
 
 
-        self.model.resize_token_embeddings(self.tokenizer.vocab_size+19717)  # 19717 nodes in PubMed graph
+        self.model.add_node_embeddings(self.tokenizer.vocab_size, 19717)  # 19717 nodes in PubMed graph
 
         self.model.tokenizer = self.tokenizer
 
+        # Recompute T5 block activations in backward instead of storing them
+        if train and self.args.gradient_checkpointing:
+            self.model.gradient_checkpointing_enable()
+            self.model.config.use_cache = False
+
         # GPU Options
         print(f'Model Launching at GPU {self.args.gpu}')
         if self.verbose:
@@ -67,25 +74,79 @@ class Trainer(TrainerBase):
 
         self.model = self.model.to(args.gpu)
 
+        # Node features are static, so move them to the GPU once instead of every step
+        loader = self.train_loader if self.train_loader is not None else self.val_loader
+        self.real_feature = loader.dataset.real_feature.to(device=args.gpu, dtype=torch.float32)
+
+        # Mixed precision: bf16 autocast needs no loss scaling, fp16 goes through GradScaler
+        self.use_amp = _use_native_amp and (self.args.fp16 or self.args.bf16)
+        self.amp_dtype = torch.bfloat16 if self.args.bf16 else torch.float16
+        if self.args.bf16:
+            self.args.fp16 = False
+
         # Optimizer
         if train:
             self.optim, self.lr_scheduler = self.create_optimizer_and_scheduler()
 
+            # Resolve the LR accessor once instead of checking the torch version every step
+            if self.lr_scheduler:
+                if version.parse(torch.__version__) >= version.parse("1.4"):
+                    self._get_lr = lambda: self.lr_scheduler.get_last_lr()[0]
+                else:
+                    self._get_lr = lambda: self.lr_scheduler.get_lr()[0]
+            else:
+                self._get_lr = lambda: self.optim.param_groups[-1]['lr']
+
             if self.args.fp16 and _use_native_amp:
                 self.scaler = torch.cuda.amp.GradScaler()
             elif _use_apex:
                 self.model, self.optim = amp.initialize(
                     self.model, self.optim, opt_level='O1', verbosity=self.verbose)
 
+            # Compile the bound forward rather than the module so state_dict keys stay unprefixed
+            if self.args.compile:
+                if hasattr(torch, 'compile'):
+                    self.model.forward = torch.compile(self.model.forward, mode='reduce-overhead', fullgraph=False)
+                elif self.verbose:
+                    print(f'torch.compile is not available in torch {torch.__version__}, running eagerly')
+
         if args.multiGPU and not args.inference:
             if args.distributed:
-                self.model = DDP(self.model, device_ids=[args.gpu])
+                # Gradients live directly in the (larger) all-reduce buckets; the graph is identical every step
+                self.model = DDP(self.model, device_ids=[args.gpu], gradient_as_bucket_view=True,
+                                 bucket_cap_mb=self.args.bucket_cap_mb, static_graph=True)
+
+                # Optionally all-reduce gradients in half precision to halve the bytes on the wire
+                hook_state = None
+                comm_hook = {
+                    'none': default_hooks.allreduce_hook,
+                    'fp16': default_hooks.fp16_compress_hook,
+                    'bf16': default_hooks.bf16_compress_hook,
+                }[self.args.comm_hook]
+
+                # The LM head (vocab + nodes rows) is the largest gradient, send it as block-wise int8
+                if self.args.quantize_lm_head_grad:
+                    hook_state = BlockQuantizedHookState(None, self.model.module.lm_head.weight, comm_hook, hook_state)
+                    comm_hook = block_quantized_hook
+
+                # The token embedding gradient only has rows for the tokens in the batch
+                if self.args.sparse_embedding_grad:
+                    hook_state = SparseRowsHookState(None, self.model.module.shared.text.weight, comm_hook, hook_state)
+                    comm_hook = sparse_rows_hook
+
+                if comm_hook is not default_hooks.allreduce_hook:
+                    self.model.register_comm_hook(state=hook_state, hook=comm_hook)
 
         if self.verbose:
             print(f'It took {time() - start:.1f}s')
 
         self.val_list=val_list
 
+        # Checkpoints per epoch: one every save_every_frac of an epoch, the last one at the epoch end
+        self.n_saves = max(1, int(round(1 / self.args.save_every_frac)))
+        if self.verbose and abs(self.n_saves * self.args.save_every_frac - 1) > 1e-6:
+            print(f'save_every_frac {self.args.save_every_frac} rounded to 1/{self.n_saves} of an epoch')
+
     def train(self):
         LOSSES_NAME = self.args.LOSSES_NAME 
 
@@ -102,6 +163,10 @@ class Trainer(TrainerBase):
         if self.args.distributed:
             dist.barrier()
 
+        # Intermediate checkpoints every 1/n_saves of an epoch, the epoch end is saved separately
+        n_saves = self.n_saves
+        save_steps = {len(self.train_loader) * k // n_saves: k for k in range(1, n_saves)}
+
         for epoch in range(self.args.epoch):
             global_step=0
 
@@ -114,77 +179,74 @@ class Trainer(TrainerBase):
             if self.verbose:
                 pbar = tqdm(total=len(self.train_loader), ncols=275)
 
-            epoch_results = {}  
-            for loss_name in LOSSES_NAME:
-                epoch_results[loss_name] = 0.
-                epoch_results[f'{loss_name}_count'] = 0
+            # Running loss sums (on the GPU) and sample counts, one slot per LOSSES_NAME entry:
+            # the tasks in InstructGLM.losses order, then the total
+            epoch_loss = torch.zeros(len(LOSSES_NAME), device=self.args.gpu)
+            epoch_count = torch.zeros(len(LOSSES_NAME), dtype=torch.long)
 
             for step_i, batch in enumerate(self.train_loader):   
-                torch.cuda.empty_cache()
-            
-                dist.barrier()
-
-                if self.args.fp16 and _use_native_amp:
-                    pass
+                # Gradients are only all-reduced on the micro-step that updates the parameters
+                update_step = step_i % self.args.gradient_accumulation_steps == 0
+                if self.args.distributed and not update_step:
+                    sync_context = self.model.no_sync()
                 else:
-                    if self.args.distributed:
-                        
-                        dddd = next(self.model.parameters()).device
-
-                        input_ids = batch['input_ids'].to(dddd)
-                        lm_labels = batch["target_ids"].to(dddd)
-
-                        loss_weights = batch["loss_weights"].to(dddd)
-                        B, L = lm_labels.size()
+                    sync_context = contextlib.nullcontext()
 
-                        output = self.model(  #forward
-                            input_ids=input_ids,
-                            real_feature=self.train_loader.dataset.real_feature.to(device=dddd,dtype=torch.float32),   
-                            labels=lm_labels,
-                            return_dict=True
-                        )
+                with sync_context:
+                    with autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                        if self.args.distributed:
+                        
+                            dddd = next(self.model.parameters()).device
 
-                        lm_mask = lm_labels != -100
-                        lm_mask = lm_mask.float()
+                            input_ids = batch['input_ids'].to(dddd, non_blocking=True)
+                            lm_labels = batch["target_ids"].to(dddd, non_blocking=True)
 
-                        loss = output['loss']
+                            loss_weights = batch["loss_weights"].to(dddd, non_blocking=True)
+                            valid_lens = batch["valid_lens"].to(dddd, non_blocking=True)
+                            B, L = lm_labels.size()
 
-                        loss = loss.view(B, L) * lm_mask   
+                            pack_kwargs = {}
+                            if self.args.pack_inputs:
+                                for key in ('packed_input_ids', 'packed_attention_mask', 'unpack_index'):
+                                    pack_kwargs[key] = batch[key].to(dddd, non_blocking=True)
 
-                        loss = loss.sum(dim=1) / lm_mask.sum(dim=1).clamp(min=1)   
+                            output = self.model(  #forward
+                                input_ids=input_ids,
+                                real_feature=self.real_feature,   
+                                labels=lm_labels,
+                                return_dict=True,
+                                **pack_kwargs
+                            )
 
-                        results = {}     #Real output for our model
+                            loss = output['loss']
 
-                        results['loss'] = (loss * loss_weights).mean()   
-                        results['total_loss'] = loss.detach().sum()
-                        results['total_loss_count'] = len(loss)
+                            # ignore_index already zeroes the -100 positions, so no extra masking is needed
+                            loss = loss.view(B, L).sum(dim=1) / valid_lens   
 
-                        task_counts = {task: 0 for task in self.model.module.losses}
-                        task_loss = {task: 0 for task in self.model.module.losses}
+                            results = {}     #Real output for our model
 
-                        for _loss, task in zip(loss.detach(), batch['task']):
-                            task_loss[task] += _loss
-                            task_counts[task] += 1
+                            results['loss'] = (loss * loss_weights).mean()   
 
-                        for task in self.model.module.losses:
-                            if task_counts[task] > 0:
-                                results[f'{task}_loss'] = task_loss[task]
-                                results[f'{task}_loss_count'] = task_counts[task]
+                            # Per-task loss sums in one kernel, counts taken from the CPU-side ids
+                            task_ids = batch['task_ids'].to(dddd, non_blocking=True)
+                            step_loss = torch.zeros(len(LOSSES_NAME), device=dddd).index_add_(0, task_ids, loss.detach().float())
+                            step_loss[-1] = loss.detach().sum()
+                            step_count = torch.bincount(batch['task_ids'], minlength=len(LOSSES_NAME))
+                            step_count[-1] = B
 
-                loss = results['loss']/self.args.gradient_accumulation_steps
-                dist.barrier()
-                if self.args.fp16 and _use_native_amp:
-                    self.scaler.scale(loss).backward()
-                elif self.args.fp16 and _use_apex:
-                    with amp.scale_loss(loss, self.optim) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
+                    loss = results['loss']/self.args.gradient_accumulation_steps
+                    if self.args.fp16 and _use_native_amp:
+                        self.scaler.scale(loss).backward()
+                    elif self.args.fp16 and _use_apex:
+                        with amp.scale_loss(loss, self.optim) as scaled_loss:
+                            scaled_loss.backward()
+                    else:
+                        loss.backward()
 
-                loss = loss.detach()
+                    loss = loss.detach()
 
                 # Update Parameters
-                if step_i % self.args.gradient_accumulation_steps==0:
+                if update_step:
 
                     if self.args.clip_grad_norm > 0:
                         if self.args.fp16 and _use_native_amp:
@@ -204,70 +266,49 @@ class Trainer(TrainerBase):
                     if self.lr_scheduler:
                         self.lr_scheduler.step()
  
-                    for param in self.model.parameters():    
-                        param.grad = None
+                    self.optim.zero_grad(set_to_none=True)
 
                 global_step += 1
-                if epoch>-1 and global_step==len(self.train_loader)//2:
+                if global_step in save_steps:
                     if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mid2.pth".format(epoch+1,self.args.lr,self.args.train))
-                        #torch.save(self.model.state_dict(),"small_pubmed_{}_{}_8_{}_mid2.pth".format(epoch+1,self.args.lr,self.args.train))
-                if epoch>-1 and global_step==len(self.train_loader)//4:
-                    if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mid1.pth".format(epoch+1,self.args.lr,self.args.train))
-                if epoch>-1 and global_step==len(self.train_loader)*3//4:
-                    if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mid3.pth".format(epoch+1,self.args.lr,self.args.train))
-                if epoch>-1 and global_step==len(self.train_loader)//8:
-                    if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mmid1.pth".format(epoch+1,self.args.lr,self.args.train))
-                if epoch>-1 and global_step==len(self.train_loader)*3//8:
-                    if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mmid2.pth".format(epoch+1,self.args.lr,self.args.train))
-                if epoch>-1 and global_step==len(self.train_loader)*5//8:
-                    if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mmid3.pth".format(epoch+1,self.args.lr,self.args.train))
-                if epoch>-1 and global_step==len(self.train_loader)*7//8:
-                    if self.verbose:
-                        torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_mend.pth".format(epoch+1,self.args.lr,self.args.train))
+                        self.save_async("flan_pubmed_{}_{}_8_{}_mid{}.pth".format(epoch+1,self.args.lr,self.args.train,save_steps[global_step]))
 
-                dist.barrier()
+                lr = self._get_lr()
 
-                if self.lr_scheduler:
-                    if version.parse(torch.__version__) >= version.parse("1.4"):
-                        lr = self.lr_scheduler.get_last_lr()[0]
-                    else:
-                        lr = self.lr_scheduler.get_lr()[0]
-                else:
-                    lr=self.optim.param_groups[-1]['lr']
+                epoch_loss += step_loss
+                epoch_count += step_count
 
-                for k, v in results.items():    
-                    if k in epoch_results:
-                        if isinstance(v, int):
-                            epoch_results[k] += v
-                        elif isinstance(v, torch.Tensor):
-                            epoch_results[k] += v.item()
+                # Only the logging rank copies the step losses to the host, with a single sync
+                if self.verbose:
+                    for loss_meter, step_sum, count in zip(loss_meters, step_loss.tolist(), step_count.tolist()):
+                        if count > 0:   
+                            loss_meter.update(step_sum / count)
 
-                if self.verbose and step_i % 1==0:       
+                if self.verbose and step_i % 10==0:       
                     desc_str = f'Epoch {epoch} | LR {lr:.6f} |'    
 
                     for i, (loss_name, loss_meter) in enumerate(zip(LOSSES_NAME, loss_meters)):
-
-                        if loss_name in results:   
-                            loss_meter.update(results[f'{loss_name}'] / results[f'{loss_name}_count'])
                         if len(loss_meter) > 0:
-                            loss_count = epoch_results[f'{loss_name}_count']     
+                            loss_count = int(epoch_count[i])     
                             desc_str += f' {loss_name} ({loss_count}) {loss_meter.val:.3f}'
 
                     pbar.set_description(desc_str)
+
+                if self.verbose:
                     pbar.update(1)
-                dist.barrier()
 
             if self.verbose:
                 pbar.close()
 
+            torch.cuda.empty_cache()
+
             dist.barrier()
 
+            epoch_results = {}  
+            for i, loss_name in enumerate(LOSSES_NAME):
+                epoch_results[loss_name] = epoch_loss[i]
+                epoch_results[f'{loss_name}_count'] = epoch_count[i]
+
             results = reduce_dict(epoch_results,average=False)    # Obtain global information
 
             dist.barrier()
@@ -293,29 +334,23 @@ class Trainer(TrainerBase):
             dist.barrier()
 
             if self.verbose and epoch>-1:
-                torch.save(self.model.state_dict(),"flan_pubmed_{}_{}_8_{}_end.pth".format(epoch+1,self.args.lr,self.args.train))
-                #torch.save(self.model.state_dict(),"small_pubmed_{}_{}_8_{}_end.pth".format(epoch+1,self.args.lr,self.args.train))
+                self.save_async("flan_pubmed_{}_{}_8_{}_end.pth".format(epoch+1,self.args.lr,self.args.train))
+                #self.save_async("small_pubmed_{}_{}_8_{}_end.pth".format(epoch+1,self.args.lr,self.args.train))
 
             dist.barrier()
+
+        if self.verbose:
+            self.wait_for_save()
             
             
 
     def test(self):   
-        for epoch in range(4*self.args.epoch):
-            if (epoch+1)%4==1:
-                ckpt_path = "flan_pubmed_{}_{}_8_{}_mid1.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-                #ckpt_path = "small_pubmed_{}_{}_8_{}_mid1.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-            elif (epoch+1)%4==2:
-                ckpt_path = "flan_pubmed_{}_{}_8_{}_mid2.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-                #ckpt_path = "small_pubmed_{}_{}_8_{}_mid2.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-            elif (epoch+1)%4==3:
-                ckpt_path = "flan_pubmed_{}_{}_8_{}_mid3.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-                #ckpt_path = "small_pubmed_{}_{}_8_{}_mid3.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-            elif (epoch+1)%4==0:
-                ckpt_path = "flan_pubmed_{}_{}_8_{}_end.pth".format(epoch//4+1,self.args.lr,self.args.train)
-                #ckpt_path = "small_pubmed_{}_{}_8_{}_end.pth".format(epoch//4+1,self.args.lr,self.args.train) 
-
-
+        n_saves = self.n_saves
+        for epoch in range(n_saves*self.args.epoch):
+            k = (epoch+1) % n_saves
+            tag = 'mid{}'.format(k) if k else 'end'
+            ckpt_path = "flan_pubmed_{}_{}_8_{}_{}.pth".format(epoch//n_saves+1,self.args.lr,self.args.train,tag) 
+            #ckpt_path = "small_pubmed_{}_{}_8_{}_{}.pth".format(epoch//n_saves+1,self.args.lr,self.args.train,tag) 
 
             #ckpt_path='(small_)best_pubmed.pth'
 
@@ -343,14 +378,7 @@ class Trainer(TrainerBase):
 
             if self.verbose:
                 acc_file=open('flan_pubmed.txt','a')                         
-                if (epoch+1)%4==1:
-                    acc_file.write(str(epoch//4+1)+'_mid1'+'\n')
-                elif (epoch+1)%4==2:
-                    acc_file.write(str(epoch//4+1)+'_mid2'+'\n')
-                elif (epoch+1)%4==3:
-                    acc_file.write(str(epoch//4+1)+'_mid3'+'\n')
-                else:
-                    acc_file.write(str(epoch//4+1)+'_end'+'\n')
+                acc_file.write(str(epoch//n_saves+1)+'_'+tag+'\n')
 
                 acc_file.write(str(valid_results)+'\n\n')
                 acc_file.close()
@@ -371,17 +399,18 @@ class Trainer(TrainerBase):
         with torch.no_grad():
             for step_i, batch in tqdm(enumerate(self.val_loader)):   
                 if self.args.distributed:
-                    results = self.model.g_step(batch,real=self.val_loader.dataset.real_feature.to(dtype=torch.float32))
-
-                for iiid in range(len(results)):    
-                    task=batch['task'][iiid]
-                    temp_id=batch['temp_ids'][iiid]
-                    if task=='classification':
-                        cate=batch['cate'][iiid] 
-                        if temp_id.endswith('2') or temp_id.endswith('4') or temp_id.endswith('6') or temp_id.endswith('7'):  #label in text format, length may be greater than 1
-                            if results[iiid].lower()==batch['target_text'][iiid]:
-                                ACC[temp_id+'-'+cate]+=1
-                dist.barrier()
+                    results = self.model.g_step(batch,real=self.real_feature)
+
+                temp_ids = np.array(batch['temp_ids'])
+                scored = np.array(batch['task']) == 'classification'
+                #label in text format, length may be greater than 1
+                scored &= np.char.endswith(temp_ids, '2') | np.char.endswith(temp_ids, '4') | np.char.endswith(temp_ids, '6') | np.char.endswith(temp_ids, '7')
+                matches = np.char.lower(np.array(results)) == np.array(batch['target_text'])
+
+                acc_keys = np.char.add(np.char.add(temp_ids, '-'), np.array(batch['cate']))
+                hit_keys, hit_counts = np.unique(acc_keys[scored & matches], return_counts=True)
+                for key, count in zip(hit_keys, hit_counts):
+                    ACC[str(key)] += int(count)
 
             return ACC   
 
@@ -65,11 +65,16 @@ def get_loader(args, task_list, sample_numbers, split='', mode='train',
     else:
         sampler = None
 
+    # Worker prefetching/persistence is only accepted by DataLoader when workers are used
+    worker_kwargs = {}
+    if workers > 0:
+        worker_kwargs = dict(prefetch_factor=4, persistent_workers=True)
+
     if mode == 'train':
         loader = DataLoader(
             dataset, batch_size=batch_size, shuffle=(sampler is None),
             num_workers=workers, pin_memory=True, sampler=sampler,
-            collate_fn=dataset.collate_fn, drop_last=False)
+            collate_fn=dataset.collate_fn, drop_last=False, **worker_kwargs)
     else:
         loader = DataLoader(
             dataset,
@@ -78,6 +83,7 @@ def get_loader(args, task_list, sample_numbers, split='', mode='train',
             sampler=sampler,
             shuffle=None if (sampler is not None) else False,
             collate_fn=dataset.collate_fn,
-            drop_last=False)
+            drop_last=False,
+            **worker_kwargs)
         
     return loader
@@ -15,7 +15,7 @@ class InstructGLM(GLM):
     def g_step(self, batch,real=None):
         self.eval()
         device = next(self.parameters()).device
-        input_ids = batch['input_ids'].to(device)
+        input_ids = batch['input_ids'].to(device, non_blocking=True)
         real=real.to(device)
 
 
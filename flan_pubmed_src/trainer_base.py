@@ -6,6 +6,7 @@ import os
 import collections
 from pathlib import Path
 from packaging import version
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from tqdm import tqdm
@@ -44,6 +45,10 @@ class TrainerBase(object):#
         if not self.verbose:
             set_global_logging_level(logging.ERROR, ["transformers"])
 
+        # Checkpoints are written by a single background thread so rank 0 does not stall training
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
+
     def create_config(self):
         from transformers import T5Config
 
@@ -154,6 +159,17 @@ class TrainerBase(object):#
             os.makedirs(self.args.output, exist_ok=True)
         torch.save(self.model.state_dict(), os.path.join(self.args.output, "%s.pth" % name))
 
+    def save_async(self, path):
+        # Snapshot the weights to CPU now, serialize them to disk in the background
+        state_dict = {k: v.detach().cpu() for k, v in self.model.state_dict().items()}
+        self.wait_for_save()
+        self.save_future = self.save_executor.submit(torch.save, state_dict, path)
+
+    def wait_for_save(self):
+        if self.save_future is not None:
+            self.save_future.result()
+            self.save_future = None
+
     def load(self, path, loc=None):
         if loc is None and hasattr(self.args, 'gpu'):
             loc = f'cuda:{self.args.gpu}'